@@ -31,22 +31,18 @@ class ImageDataset(Dataset):
                 ]
             )
 
-        self.imgname_csv = []
-        self.labels_csv = []
         self.files = []
         self.labels = []
         with open(self.csv_path, "r", newline="") as file:
             reader = csv.reader(file, delimiter=",")
             next(reader)
-            for row in reader:
-                img_name, label = row
-                self.imgname_csv.append(img_name)
-                self.labels_csv.append(torch.tensor(int(label)))
+            # image name -> label, O(1) lookup below
+            self.label_map = {img_name: int(label) for img_name, label in reader}
 
         for x in os.listdir(self.path):
-            if x.endswith(".png") and x in self.imgname_csv:
+            if x.endswith(".png") and x in self.label_map:
                 self.files.append(os.path.join(self.path, x))
-                self.labels.append(self.labels_csv[self.imgname_csv.index(x)])
+                self.labels.append(torch.tensor(self.label_map[x]))
 
     def __getitem__(self, idx):
         data = Image.open(self.files[idx])
@@ -57,7 +53,7 @@ class ImageDataset(Dataset):
         return len(self.files)
 
 
-def output_images(save_dir, model_path):
+def output_images(save_dir, model_path, upsample="transpose"):
 
     # hardcoding these here
     n_T = 500  # 500
@@ -67,7 +63,7 @@ def output_images(save_dir, model_path):
     n_classes = 10
 
     ddpm1 = DDPM(
-        nn_model=ContextUnet(in_channels=3, n_feat=256, n_classes=10),
+        nn_model=ContextUnet(in_channels=3, n_feat=256, n_classes=10, upsample=upsample),
         betas=(1e-4, 0.02),
         n_T=500,
         device=device,
@@ -75,7 +71,7 @@ def output_images(save_dir, model_path):
     )
 
     ddpm2 = DDPM(
-        nn_model=ContextUnet(in_channels=3, n_feat=128, n_classes=10),
+        nn_model=ContextUnet(in_channels=3, n_feat=128, n_classes=10, upsample=upsample),
         betas=(1e-4, 0.02),
         n_T=500,
         device=device,
@@ -99,7 +95,7 @@ def output_images(save_dir, model_path):
     # for eval, save an image of currently generated samples (top rows)
     # followed by real images (bottom rows)
     ddpm.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         n_sample = 50 * n_classes
 
         with torch.autocast(device_type=device):
@@ -131,7 +127,7 @@ def output_images(save_dir, model_path):
     # for eval, save an image of currently generated samples (top rows)
     # followed by real images (bottom rows)
     ddpm.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         n_sample = 50 * n_classes
 
         with torch.autocast(device_type=device):
@@ -158,6 +154,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--output_image_dir', type=pathlib.Path, required=True)
     parser.add_argument("--model_path", type=pathlib.Path, required=False, default='combined_ddpm.pth')
+    parser.add_argument("--upsample", choices=["transpose", "nearest"], default="transpose")
     args = parser.parse_args()
     
     os.makedirs(args.output_image_dir, exist_ok=True)
@@ -167,5 +164,5 @@ if __name__ == "__main__":
     """
     from datetime import datetime
     print(datetime.now())
-    output_images(save_dir=args.output_image_dir, model_path=args.model_path)
+    output_images(save_dir=args.output_image_dir, model_path=args.model_path, upsample=args.upsample)
     print(datetime.now())
\ No newline at end of file
@@ -1,25 +1,52 @@
 import torch
 import torch.nn as nn
-import numpy as np
 import torch.nn.functional as F
 from torchvision import models, transforms
 
 
 
 class DDPM(nn.Module):
-    def __init__(self, nn_model, betas, n_T, device, drop_prob=0.1):
+    def __init__(self, nn_model, betas, n_T, device, drop_prob=0.1, compile_model=False):
         super(DDPM, self).__init__()
         self.nn_model = nn_model.to(device)
 
-        # register_buffer allows accessing dictionary produced by ddpm_schedules
-        # e.g. can access self.sqrtab later
-        for k, v in ddpm_schedules(betas[0], betas[1], n_T).items():
-            self.register_buffer(k, v)
+        # all schedules in one contiguous buffer, e.g. self.sched[SCHEDULE_ROWS["sqrtab"]]
+        # derived from betas, so it is not saved in the state_dict
+        self.register_buffer(
+            "sched", ddpm_schedules(betas[0], betas[1], n_T), persistent=False
+        )
 
         self.n_T = n_T
         self.device = device
         self.drop_prob = drop_prob
-        self.loss_mse = nn.MSELoss()
+
+        # step indices live on device so the compiled sampling step never
+        # specializes on the python loop counter
+        self.register_buffer("steps", torch.arange(0, n_T + 1), persistent=False)
+        # normalized timesteps t / n_T, indexed instead of dividing every step
+        self.register_buffer(
+            "t_norm", torch.arange(0, n_T + 1, dtype=torch.float32) / n_T, persistent=False
+        )
+        # 1/\sqrt{\alpha_t} * (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}, noise coefficient of X(t-1)
+        self.register_buffer(
+            "eps_coef",
+            self.sched[SCHEDULE_ROWS["oneover_sqrta"]]
+            * self.sched[SCHEDULE_ROWS["mab_over_sqrtmab"]],
+            persistent=False,
+        )
+
+        self._sample_step_fn = self._sample_step
+        if compile_model:
+            # compile in place so state_dict keys stay unchanged
+            self.nn_model.compile(mode="reduce-overhead", dynamic=False)
+            self._sample_step_fn = torch.compile(self._sample_step, dynamic=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved every schedule as its own buffer, they are
+        # rebuilt from betas anyway
+        for k in SCHEDULE_ROWS:
+            state_dict.pop(prefix + k, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, c):
 
@@ -33,67 +60,118 @@ class DDPM(nn.Module):
         eps = torch.randn_like(x)
 
         # Step 5-1: Xt
+        sched_t = self.sched[:, t, None, None, None]
         x_t = (
-            self.sqrtab[t, None, None, None] * x
-            + self.sqrtmab[t, None, None, None] * eps
-        )  
+            sched_t[SCHEDULE_ROWS["sqrtab"]] * x
+            + sched_t[SCHEDULE_ROWS["sqrtmab"]] * eps
+        )
 
         # dropout context with some probability
         context_mask = torch.bernoulli(torch.zeros_like(c) + self.drop_prob).to(self.device)
 
         # Step 5-2: predicted noise
-        eps_pred = self.nn_model(x_t, c, t / self.n_T, context_mask)
+        eps_pred = self.nn_model(x_t, c, self.t_norm[t], context_mask)
 
         # Step 5-3: compute loss
-        return self.loss_mse(eps, eps_pred)
+        return F.mse_loss(eps_pred, eps)
 
 
     def sample(self, n_sample, size, device, guide_w=0.0):
 
         """
         Sampling
+
+        guide_w can also be a list of guidance strengths, all of them are
+        sampled in the same batch and the outputs get a leading (W,) dim
         """
+        guide_w = torch.as_tensor(guide_w, dtype=torch.float32, device=device)
+        batched_w = guide_w.dim() > 0
+        guide_w = guide_w.reshape(-1)
+        n_total = guide_w.shape[0] * n_sample
+        # one guidance strength per sample, broadcast over (C, H, W)
+        guide_w = guide_w.repeat_interleave(n_sample).view(-1, 1, 1, 1)
+
         # Step 1: XT ~ N(0, I), initial noise
-        Xt = torch.randn(n_sample, *size).to(device)
+        Xt = torch.randn(n_total, *size, device=device).contiguous(
+            memory_format=torch.channels_last
+        )
 
-        c_i = torch.arange(0, 10).to(device)
-        c_i = c_i.repeat(int(n_sample / c_i.shape[0]))
-        context_mask = torch.zeros_like(c_i).to(device)
+        c_i = torch.arange(0, 10, device=device)
+        c_i = c_i.repeat(int(n_total / c_i.shape[0]))
+        context_mask = torch.zeros_like(c_i)
         c_i = c_i.repeat(2)
         context_mask = context_mask.repeat(2)
-        context_mask[n_sample:] = 1.0
-        Xt_store = []
+        context_mask[n_total:] = 1.0
+
+        # snapshots go into one pinned host buffer with async copies,
+        # synchronized once after the loop instead of on every snapshot
+        store_steps = [
+            i for i in range(self.n_T, 0, -1) if i % 20 == 0 or i == self.n_T or i < 8
+        ]
+        Xt_store = torch.empty(
+            len(store_steps), n_total, *size, pin_memory=torch.cuda.is_available()
+        )
+        k = 0
+
+        # conditional / unconditional batch and noise, reused across all steps
+        xt_buf = torch.empty(
+            2 * n_total, *size, device=device, memory_format=torch.channels_last
+        )
+        z_buf = torch.empty(
+            n_total, *size, device=device, memory_format=torch.channels_last
+        )
 
         # Step 2: t = T,T-1,...,1
         for i in range(self.n_T, 0, -1):
             print(f"sampling timestep {i}", end="\r")
-            t_is = torch.tensor([i / self.n_T]).to(device)
-            t_is = t_is.repeat(n_sample, 1, 1, 1)
-            Xt = Xt.repeat(2, 1, 1, 1)
-            t_is = t_is.repeat(2, 1, 1, 1)
+            xt_buf[:n_total].copy_(Xt)
+            xt_buf[n_total:].copy_(Xt)
+            t_is = self.t_norm[i].view(1, 1, 1, 1).expand(2 * n_total, 1, 1, 1)
 
             # Step 3: z ~ N(0, I)
-            z = torch.randn(n_sample, *size).to(device) if i > 1 else 0
-
-            # Step 4-1: predicted noise
-            eps = self.nn_model(Xt, c_i, t_is, context_mask)
-
-            # Step 4-2: X(t-1)
-            eps1 = eps[:n_sample]  # with condition
-            eps2 = eps[n_sample:]  # without condition
-            eps = (1 + guide_w) * eps1 - guide_w * eps2
-            Xt = Xt[:n_sample]
-            Xt = (
-                self.oneover_sqrta[i] * (Xt - eps * self.mab_over_sqrtmab[i])
-                + self.sqrt_beta_t[i] * z
+            z = z_buf.normal_() if i > 1 else 0
+
+            # Step 4: X(t-1)
+            Xt = self._sample_step_fn(
+                xt_buf, c_i, t_is, context_mask, z, self.steps[i], guide_w
             )
             if i % 20 == 0 or i == self.n_T or i < 8:
-                Xt_store.append(Xt.detach().cpu().numpy())
+                Xt_store[k].copy_(Xt.detach(), non_blocking=True)
+                k += 1
+
+        if Xt.is_cuda:
+            torch.cuda.synchronize(Xt.device)
+        Xt_store = Xt_store.numpy()
 
-        Xt_store = np.array(Xt_store)
+        if batched_w:
+            Xt = Xt.view(-1, n_sample, *size)
+            Xt_store = Xt_store.reshape(len(Xt_store), -1, n_sample, *size)
 
         return Xt, Xt_store
 
+    def _sample_step(self, Xt, c_i, t_is, context_mask, z, i, guide_w):
+        """
+        One reverse diffusion step, Xt holds the sample twice (with / without
+        condition), guide_w is per sample and i is a 0-dim index tensor on device
+        """
+        n_sample = Xt.shape[0] // 2
+
+        # Step 4-1: predicted noise
+        eps = self.nn_model(Xt, c_i, t_is, context_mask)
+
+        # Step 4-2: X(t-1)
+        eps1 = eps[:n_sample]  # with condition
+        eps2 = eps[n_sample:]  # without condition
+        eps = (1 + guide_w) * eps1 - guide_w * eps2
+        Xt = Xt[:n_sample]
+        sched_i = self.sched[:, i]
+        Xt = (
+            sched_i[SCHEDULE_ROWS["oneover_sqrta"]] * Xt
+            - self.eps_coef[i] * eps
+            + sched_i[SCHEDULE_ROWS["sqrt_beta_t"]] * z
+        )
+        return Xt
+
 
 class ResidualConvBlock(nn.Module):
     def __init__(
@@ -146,13 +224,21 @@ class UnetDown(nn.Module):
 
 
 class UnetUp(nn.Module):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, upsample="transpose"):
         super(UnetUp, self).__init__()
         """
         process and upscale the image feature maps
         """
+        if upsample == "nearest":
+            # no transpose conv kernel and no checkerboard artifacts
+            up = nn.Sequential(
+                nn.Upsample(scale_factor=2, mode="nearest"),
+                nn.Conv2d(in_channels, out_channels, 3, 1, 1),
+            )
+        else:
+            up = nn.ConvTranspose2d(in_channels, out_channels, 2, 2)
         layers = [
-            nn.ConvTranspose2d(in_channels, out_channels, 2, 2),
+            up,
             ResidualConvBlock(out_channels, out_channels),
             ResidualConvBlock(out_channels, out_channels),
         ]
@@ -168,9 +254,8 @@ class EmbedFC(nn.Module):
     def __init__(self, input_dim, emb_dim):
         super(EmbedFC, self).__init__()
         """
-        generic one layer FC NN for embedding things  
+        generic one layer FC NN for embedding things, expects (B, input_dim) inputs
         """
-        self.input_dim = input_dim
         layers = [
             nn.Linear(input_dim, emb_dim),
             nn.GELU(),
@@ -179,13 +264,41 @@ class EmbedFC(nn.Module):
         self.model = nn.Sequential(*layers)
 
     def forward(self, x):
-        x = x.view(-1, self.input_dim)
         return self.model(x)
 
 
+class EmbedContext(nn.Module):
+    def __init__(self, n_classes, emb_dim):
+        super(EmbedContext, self).__init__()
+        """
+        label embedding, row n_classes is the null (unconditional) context
+        """
+        layers = [
+            nn.Embedding(n_classes + 1, emb_dim),
+            nn.GELU(),
+            nn.Linear(emb_dim, emb_dim),
+        ]
+        self.model = nn.Sequential(*layers)
+
+    def forward(self, idx):
+        return self.model(idx)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from the one-hot EmbedFC: Linear(-one_hot(c)) = b - W[:, c]
+        # and the masked (all zero) context gives just b
+        bias_key = prefix + "model.0.bias"
+        if bias_key in state_dict:
+            w = state_dict.pop(prefix + "model.0.weight")
+            b = state_dict.pop(bias_key)
+            state_dict[prefix + "model.0.weight"] = torch.cat([b - w.t(), b[None]])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class ContextUnet(nn.Module):
-    def __init__(self, in_channels, n_feat=256, n_classes=10):
+    def __init__(self, in_channels, n_feat=256, n_classes=10, upsample="transpose"):
         super(ContextUnet, self).__init__()
+        # upsample="nearest" swaps the ConvTranspose2d in UnetUp for Upsample + Conv2d,
+        # an architectural variant that needs its own checkpoints
 
         # %% 參數設定
         self.in_channels = in_channels
@@ -201,9 +314,11 @@ class ContextUnet(nn.Module):
 
         self.timeembed1 = EmbedFC(1, 2 * n_feat)
         self.timeembed2 = EmbedFC(1, 1 * n_feat)
-        self.contextembed1 = EmbedFC(n_classes, 2 * n_feat)
-        self.contextembed2 = EmbedFC(n_classes, 1 * n_feat)
+        self.contextembed1 = EmbedContext(n_classes, 2 * n_feat)
+        self.contextembed2 = EmbedContext(n_classes, 1 * n_feat)
 
+        # up0 keeps the transpose conv in both variants: it expands the 1x1
+        # hiddenvec with 49 independent positions (stride 7, no overlap)
         self.up0 = nn.Sequential(
             # nn.ConvTranspose2d(6 * n_feat, 2 * n_feat, 7, 7), # when concat temb and cemb end up w 6*n_feat
             nn.ConvTranspose2d(
@@ -213,8 +328,8 @@ class ContextUnet(nn.Module):
             nn.ReLU(),
         )
 
-        self.up1 = UnetUp(4 * n_feat, n_feat)
-        self.up2 = UnetUp(2 * n_feat, n_feat)
+        self.up1 = UnetUp(4 * n_feat, n_feat, upsample)
+        self.up2 = UnetUp(2 * n_feat, n_feat, upsample)
         self.out = nn.Sequential(
             nn.Conv2d(2 * n_feat, n_feat, 3, 1, 1),
             nn.GroupNorm(8, n_feat),
@@ -232,31 +347,41 @@ class ContextUnet(nn.Module):
         down2 = self.down2(down1)
         hiddenvec = self.to_vec(down2)
 
-        # convert context to one hot embedding
-        c = nn.functional.one_hot(c, num_classes=self.n_classes).type(torch.float)
+        # mask out context if context_mask == 1, masked samples use the null row
+        null_c = torch.full_like(c, self.n_classes)
+        c = torch.where(context_mask.bool(), null_c, c)  # 決定是否要有condition
 
-        # mask out context if context_mask == 1
-        context_mask = context_mask[:, None]
-        context_mask = context_mask.repeat(1, self.n_classes)
-        context_mask = -1 * (1 - context_mask)  # need to flip 0 <-> 1
-        c = c * context_mask  # 決定是否要有condition
-
-        # embed context, time step
+        # embed context, time step (flattened once to (B, 1) for both EmbedFC)
+        t = t.reshape(t.shape[0], -1)
         cemb1 = self.contextembed1(c).view(-1, self.n_feat * 2, 1, 1)
         temb1 = self.timeembed1(t).view(-1, self.n_feat * 2, 1, 1)
         cemb2 = self.contextembed2(c).view(-1, self.n_feat, 1, 1)
         temb2 = self.timeembed2(t).view(-1, self.n_feat, 1, 1)
 
         up1 = self.up0(hiddenvec)
-        up2 = self.up1(cemb1 * up1 + temb1, down2)  # add and multiply embeddings
-        up3 = self.up2(cemb2 * up2 + temb2, down1)
+        # add and multiply embeddings, addcmul does cemb * up + temb in one kernel
+        up2 = self.up1(torch.addcmul(temb1, cemb1, up1), down2)
+        up3 = self.up2(torch.addcmul(temb2, cemb2, up2), down1)
         out = self.out(torch.cat((up3, x), 1))
         return out
 
 
+# row of each schedule in the (7, T + 1) tensor returned by ddpm_schedules
+SCHEDULE_ROWS = {
+    "alpha_t": 0,  # \alpha_t
+    "oneover_sqrta": 1,  # 1/\sqrt{\alpha_t}
+    "sqrt_beta_t": 2,  # \sqrt{\beta_t}
+    "alphabar_t": 3,  # \bar{\alpha_t}
+    "sqrtab": 4,  # \sqrt{\bar{\alpha_t}}
+    "sqrtmab": 5,  # \sqrt{1-\bar{\alpha_t}}
+    "mab_over_sqrtmab": 6,  # (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}
+}
+
+
 def ddpm_schedules(beta1, beta2, T):
     """
-    Returns pre-computed schedules for DDPM sampling, training process.
+    Returns pre-computed schedules for DDPM sampling, training process,
+    packed into one (7, T + 1) tensor, see SCHEDULE_ROWS for the row order.
     """
     assert beta1 < beta2 < 1.0, "beta1 and beta2 must be in (0, 1)"
 
@@ -272,15 +397,17 @@ def ddpm_schedules(beta1, beta2, T):
     sqrtmab = torch.sqrt(1 - alphabar_t)
     mab_over_sqrtmab_inv = (1 - alpha_t) / sqrtmab
 
-    return {
-        "alpha_t": alpha_t,  # \alpha_t
-        "oneover_sqrta": oneover_sqrta,  # 1/\sqrt{\alpha_t}
-        "sqrt_beta_t": sqrt_beta_t,  # \sqrt{\beta_t}
-        "alphabar_t": alphabar_t,  # \bar{\alpha_t}
-        "sqrtab": sqrtab,  # \sqrt{\bar{\alpha_t}}
-        "sqrtmab": sqrtmab,  # \sqrt{1-\bar{\alpha_t}}
-        "mab_over_sqrtmab": mab_over_sqrtmab_inv,  # (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}
-    }
+    return torch.stack(
+        [
+            alpha_t,
+            oneover_sqrta,
+            sqrt_beta_t,
+            alphabar_t,
+            sqrtab,
+            sqrtmab,
+            mab_over_sqrtmab_inv,
+        ]
+    )
 
 class CombinedDDPM(nn.Module):
     def __init__(self, ddpm1, ddpm2):
@@ -307,9 +434,10 @@ class CombinedDDPM(nn.Module):
 if __name__ == "__main__":
 
     device = torch.device("cuda:2" if torch.cuda.is_available() else "cpu")
+    upsample = "transpose"  # must match the upsample used in p1_train.py
 
     ddpm1 = DDPM(
-        nn_model=ContextUnet(in_channels=3, n_feat=256, n_classes=10),
+        nn_model=ContextUnet(in_channels=3, n_feat=256, n_classes=10, upsample=upsample),
         betas=(1e-4, 0.02),
         n_T=500,
         device=device,
@@ -317,7 +445,7 @@ if __name__ == "__main__":
     )
 
     ddpm2 = ddpm = DDPM(
-        nn_model=ContextUnet(in_channels=3, n_feat=128, n_classes=10),
+        nn_model=ContextUnet(in_channels=3, n_feat=128, n_classes=10, upsample=upsample),
         betas=(1e-4, 0.02),
         n_T=500,
         device=device,
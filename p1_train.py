@@ -4,7 +4,9 @@ import torch
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import models, transforms
 import torchvision.transforms as trns
 from torchvision.datasets import MNIST
@@ -69,13 +71,21 @@ class UnetDown(nn.Module):
 
 
 class UnetUp(nn.Module):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, upsample="transpose"):
         super(UnetUp, self).__init__()
         """
         process and upscale the image feature maps
         """
+        if upsample == "nearest":
+            # no transpose conv kernel and no checkerboard artifacts
+            up = nn.Sequential(
+                nn.Upsample(scale_factor=2, mode="nearest"),
+                nn.Conv2d(in_channels, out_channels, 3, 1, 1),
+            )
+        else:
+            up = nn.ConvTranspose2d(in_channels, out_channels, 2, 2)
         layers = [
-            nn.ConvTranspose2d(in_channels, out_channels, 2, 2),
+            up,
             ResidualConvBlock(out_channels, out_channels),
             ResidualConvBlock(out_channels, out_channels),
         ]
@@ -91,9 +101,8 @@ class EmbedFC(nn.Module):
     def __init__(self, input_dim, emb_dim):
         super(EmbedFC, self).__init__()
         """
-        generic one layer FC NN for embedding things  
+        generic one layer FC NN for embedding things, expects (B, input_dim) inputs
         """
-        self.input_dim = input_dim
         layers = [
             nn.Linear(input_dim, emb_dim),
             nn.GELU(),
@@ -102,13 +111,41 @@ class EmbedFC(nn.Module):
         self.model = nn.Sequential(*layers)
 
     def forward(self, x):
-        x = x.view(-1, self.input_dim)
         return self.model(x)
 
 
+class EmbedContext(nn.Module):
+    def __init__(self, n_classes, emb_dim):
+        super(EmbedContext, self).__init__()
+        """
+        label embedding, row n_classes is the null (unconditional) context
+        """
+        layers = [
+            nn.Embedding(n_classes + 1, emb_dim),
+            nn.GELU(),
+            nn.Linear(emb_dim, emb_dim),
+        ]
+        self.model = nn.Sequential(*layers)
+
+    def forward(self, idx):
+        return self.model(idx)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from the one-hot EmbedFC: Linear(-one_hot(c)) = b - W[:, c]
+        # and the masked (all zero) context gives just b
+        bias_key = prefix + "model.0.bias"
+        if bias_key in state_dict:
+            w = state_dict.pop(prefix + "model.0.weight")
+            b = state_dict.pop(bias_key)
+            state_dict[prefix + "model.0.weight"] = torch.cat([b - w.t(), b[None]])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class ContextUnet(nn.Module):
-    def __init__(self, in_channels, n_feat=256, n_classes=10):
+    def __init__(self, in_channels, n_feat=256, n_classes=10, upsample="transpose"):
         super(ContextUnet, self).__init__()
+        # upsample="nearest" swaps the ConvTranspose2d in UnetUp for Upsample + Conv2d,
+        # an architectural variant that needs its own checkpoints
 
         # %% 參數設定
         self.in_channels = in_channels
@@ -124,9 +161,11 @@ class ContextUnet(nn.Module):
 
         self.timeembed1 = EmbedFC(1, 2 * n_feat)
         self.timeembed2 = EmbedFC(1, 1 * n_feat)
-        self.contextembed1 = EmbedFC(n_classes, 2 * n_feat)
-        self.contextembed2 = EmbedFC(n_classes, 1 * n_feat)
+        self.contextembed1 = EmbedContext(n_classes, 2 * n_feat)
+        self.contextembed2 = EmbedContext(n_classes, 1 * n_feat)
 
+        # up0 keeps the transpose conv in both variants: it expands the 1x1
+        # hiddenvec with 49 independent positions (stride 7, no overlap)
         self.up0 = nn.Sequential(
             # nn.ConvTranspose2d(6 * n_feat, 2 * n_feat, 7, 7), # when concat temb and cemb end up w 6*n_feat
             nn.ConvTranspose2d(
@@ -136,8 +175,8 @@ class ContextUnet(nn.Module):
             nn.ReLU(),
         )
 
-        self.up1 = UnetUp(4 * n_feat, n_feat)
-        self.up2 = UnetUp(2 * n_feat, n_feat)
+        self.up1 = UnetUp(4 * n_feat, n_feat, upsample)
+        self.up2 = UnetUp(2 * n_feat, n_feat, upsample)
         self.out = nn.Sequential(
             nn.Conv2d(2 * n_feat, n_feat, 3, 1, 1),
             nn.GroupNorm(8, n_feat),
@@ -155,31 +194,41 @@ class ContextUnet(nn.Module):
         down2 = self.down2(down1)
         hiddenvec = self.to_vec(down2)
 
-        # convert context to one hot embedding
-        c = nn.functional.one_hot(c, num_classes=self.n_classes).type(torch.float)
-
-        # mask out context if context_mask == 1
-        context_mask = context_mask[:, None]
-        context_mask = context_mask.repeat(1, self.n_classes)
-        context_mask = -1 * (1 - context_mask)  # need to flip 0 <-> 1
-        c = c * context_mask  # 決定是否要有condition
+        # mask out context if context_mask == 1, masked samples use the null row
+        null_c = torch.full_like(c, self.n_classes)
+        c = torch.where(context_mask.bool(), null_c, c)  # 決定是否要有condition
 
-        # embed context, time step
+        # embed context, time step (flattened once to (B, 1) for both EmbedFC)
+        t = t.reshape(t.shape[0], -1)
         cemb1 = self.contextembed1(c).view(-1, self.n_feat * 2, 1, 1)
         temb1 = self.timeembed1(t).view(-1, self.n_feat * 2, 1, 1)
         cemb2 = self.contextembed2(c).view(-1, self.n_feat, 1, 1)
         temb2 = self.timeembed2(t).view(-1, self.n_feat, 1, 1)
 
         up1 = self.up0(hiddenvec)
-        up2 = self.up1(cemb1 * up1 + temb1, down2)  # add and multiply embeddings
-        up3 = self.up2(cemb2 * up2 + temb2, down1)
+        # add and multiply embeddings, addcmul does cemb * up + temb in one kernel
+        up2 = self.up1(torch.addcmul(temb1, cemb1, up1), down2)
+        up3 = self.up2(torch.addcmul(temb2, cemb2, up2), down1)
         out = self.out(torch.cat((up3, x), 1))
         return out
 
 
+# row of each schedule in the (7, T + 1) tensor returned by ddpm_schedules
+SCHEDULE_ROWS = {
+    "alpha_t": 0,  # \alpha_t
+    "oneover_sqrta": 1,  # 1/\sqrt{\alpha_t}
+    "sqrt_beta_t": 2,  # \sqrt{\beta_t}
+    "alphabar_t": 3,  # \bar{\alpha_t}
+    "sqrtab": 4,  # \sqrt{\bar{\alpha_t}}
+    "sqrtmab": 5,  # \sqrt{1-\bar{\alpha_t}}
+    "mab_over_sqrtmab": 6,  # (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}
+}
+
+
 def ddpm_schedules(beta1, beta2, T):
     """
-    Returns pre-computed schedules for DDPM sampling, training process.
+    Returns pre-computed schedules for DDPM sampling, training process,
+    packed into one (7, T + 1) tensor, see SCHEDULE_ROWS for the row order.
     """
     assert beta1 < beta2 < 1.0, "beta1 and beta2 must be in (0, 1)"
 
@@ -195,31 +244,61 @@ def ddpm_schedules(beta1, beta2, T):
     sqrtmab = torch.sqrt(1 - alphabar_t)
     mab_over_sqrtmab_inv = (1 - alpha_t) / sqrtmab
 
-    return {
-        "alpha_t": alpha_t,  # \alpha_t
-        "oneover_sqrta": oneover_sqrta,  # 1/\sqrt{\alpha_t}
-        "sqrt_beta_t": sqrt_beta_t,  # \sqrt{\beta_t}
-        "alphabar_t": alphabar_t,  # \bar{\alpha_t}
-        "sqrtab": sqrtab,  # \sqrt{\bar{\alpha_t}}
-        "sqrtmab": sqrtmab,  # \sqrt{1-\bar{\alpha_t}}
-        "mab_over_sqrtmab": mab_over_sqrtmab_inv,  # (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}
-    }
+    return torch.stack(
+        [
+            alpha_t,
+            oneover_sqrta,
+            sqrt_beta_t,
+            alphabar_t,
+            sqrtab,
+            sqrtmab,
+            mab_over_sqrtmab_inv,
+        ]
+    )
 
 
 class DDPM(nn.Module):
-    def __init__(self, nn_model, betas, n_T, device, drop_prob=0.1):
+    def __init__(self, nn_model, betas, n_T, device, drop_prob=0.1, compile_model=False):
         super(DDPM, self).__init__()
         self.nn_model = nn_model.to(device)
 
-        # register_buffer allows accessing dictionary produced by ddpm_schedules
-        # e.g. can access self.sqrtab later
-        for k, v in ddpm_schedules(betas[0], betas[1], n_T).items():
-            self.register_buffer(k, v)
+        # all schedules in one contiguous buffer, e.g. self.sched[SCHEDULE_ROWS["sqrtab"]]
+        # derived from betas, so it is not saved in the state_dict
+        self.register_buffer(
+            "sched", ddpm_schedules(betas[0], betas[1], n_T), persistent=False
+        )
 
         self.n_T = n_T
         self.device = device
         self.drop_prob = drop_prob
-        self.loss_mse = nn.MSELoss()
+
+        # step indices live on device so the compiled sampling step never
+        # specializes on the python loop counter
+        self.register_buffer("steps", torch.arange(0, n_T + 1), persistent=False)
+        # normalized timesteps t / n_T, indexed instead of dividing every step
+        self.register_buffer(
+            "t_norm", torch.arange(0, n_T + 1, dtype=torch.float32) / n_T, persistent=False
+        )
+        # 1/\sqrt{\alpha_t} * (1-\alpha_t)/\sqrt{1-\bar{\alpha_t}}, noise coefficient of X(t-1)
+        self.register_buffer(
+            "eps_coef",
+            self.sched[SCHEDULE_ROWS["oneover_sqrta"]]
+            * self.sched[SCHEDULE_ROWS["mab_over_sqrtmab"]],
+            persistent=False,
+        )
+
+        self._sample_step_fn = self._sample_step
+        if compile_model:
+            # compile in place so state_dict keys stay unchanged
+            self.nn_model.compile(mode="reduce-overhead", dynamic=False)
+            self._sample_step_fn = torch.compile(self._sample_step, dynamic=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints saved every schedule as its own buffer, they are
+        # rebuilt from betas anyway
+        for k in SCHEDULE_ROWS:
+            state_dict.pop(prefix + k, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, c):
 
@@ -233,72 +312,144 @@ class DDPM(nn.Module):
         eps = torch.randn_like(x)
 
         # Step 5-1: Xt
+        sched_t = self.sched[:, t, None, None, None]
         x_t = (
-            self.sqrtab[t, None, None, None] * x
-            + self.sqrtmab[t, None, None, None] * eps
-        )  
+            sched_t[SCHEDULE_ROWS["sqrtab"]] * x
+            + sched_t[SCHEDULE_ROWS["sqrtmab"]] * eps
+        )
 
         # dropout context with some probability
         context_mask = torch.bernoulli(torch.zeros_like(c) + self.drop_prob).to(self.device)
 
         # Step 5-2: predicted noise
-        eps_pred = self.nn_model(x_t, c, t / self.n_T, context_mask)
+        eps_pred = self.nn_model(x_t, c, self.t_norm[t], context_mask)
 
         # Step 5-3: compute loss
-        return self.loss_mse(eps, eps_pred)
+        return F.mse_loss(eps_pred, eps)
 
 
     def sample(self, n_sample, size, device, guide_w=0.0):
 
         """
         Sampling
+
+        guide_w can also be a list of guidance strengths, all of them are
+        sampled in the same batch and the outputs get a leading (W,) dim
         """
+        guide_w = torch.as_tensor(guide_w, dtype=torch.float32, device=device)
+        batched_w = guide_w.dim() > 0
+        guide_w = guide_w.reshape(-1)
+        n_total = guide_w.shape[0] * n_sample
+        # one guidance strength per sample, broadcast over (C, H, W)
+        guide_w = guide_w.repeat_interleave(n_sample).view(-1, 1, 1, 1)
+
         # Step 1: XT ~ N(0, I), initial noise
-        Xt = torch.randn(n_sample, *size).to(device)
+        Xt = torch.randn(n_total, *size, device=device).contiguous(
+            memory_format=torch.channels_last
+        )
 
-        c_i = torch.arange(0, 10).to(device)
-        c_i = c_i.repeat(int(n_sample / c_i.shape[0]))
-        context_mask = torch.zeros_like(c_i).to(device)
+        c_i = torch.arange(0, 10, device=device)
+        c_i = c_i.repeat(int(n_total / c_i.shape[0]))
+        context_mask = torch.zeros_like(c_i)
         c_i = c_i.repeat(2)
         context_mask = context_mask.repeat(2)
-        context_mask[n_sample:] = 1.0
-        Xt_store = []
+        context_mask[n_total:] = 1.0
+
+        # snapshots go into one pinned host buffer with async copies,
+        # synchronized once after the loop instead of on every snapshot
+        store_steps = [
+            i for i in range(self.n_T, 0, -1) if i % 20 == 0 or i == self.n_T or i < 8
+        ]
+        Xt_store = torch.empty(
+            len(store_steps), n_total, *size, pin_memory=torch.cuda.is_available()
+        )
+        k = 0
+
+        # conditional / unconditional batch and noise, reused across all steps
+        xt_buf = torch.empty(
+            2 * n_total, *size, device=device, memory_format=torch.channels_last
+        )
+        z_buf = torch.empty(
+            n_total, *size, device=device, memory_format=torch.channels_last
+        )
 
         # Step 2: t = T,T-1,...,1
         for i in range(self.n_T, 0, -1):
             print(f"sampling timestep {i}", end="\r")
-            t_is = torch.tensor([i / self.n_T]).to(device)
-            t_is = t_is.repeat(n_sample, 1, 1, 1)
-            Xt = Xt.repeat(2, 1, 1, 1)
-            t_is = t_is.repeat(2, 1, 1, 1)
+            xt_buf[:n_total].copy_(Xt)
+            xt_buf[n_total:].copy_(Xt)
+            t_is = self.t_norm[i].view(1, 1, 1, 1).expand(2 * n_total, 1, 1, 1)
 
             # Step 3: z ~ N(0, I)
-            z = torch.randn(n_sample, *size).to(device) if i > 1 else 0
-
-            # Step 4-1: predicted noise
-            eps = self.nn_model(Xt, c_i, t_is, context_mask)
-
-            # Step 4-2: X(t-1)
-            eps1 = eps[:n_sample]  # with condition
-            eps2 = eps[n_sample:]  # without condition
-            eps = (1 + guide_w) * eps1 - guide_w * eps2
-            Xt = Xt[:n_sample]
-            Xt = (
-                self.oneover_sqrta[i] * (Xt - eps * self.mab_over_sqrtmab[i])
-                + self.sqrt_beta_t[i] * z
+            z = z_buf.normal_() if i > 1 else 0
+
+            # Step 4: X(t-1)
+            Xt = self._sample_step_fn(
+                xt_buf, c_i, t_is, context_mask, z, self.steps[i], guide_w
             )
             if i % 20 == 0 or i == self.n_T or i < 8:
-                Xt_store.append(Xt.detach().cpu().numpy())
+                Xt_store[k].copy_(Xt.detach(), non_blocking=True)
+                k += 1
+
+        if Xt.is_cuda:
+            torch.cuda.synchronize(Xt.device)
+        Xt_store = Xt_store.numpy()
 
-        Xt_store = np.array(Xt_store)
+        if batched_w:
+            Xt = Xt.view(-1, n_sample, *size)
+            Xt_store = Xt_store.reshape(len(Xt_store), -1, n_sample, *size)
 
         return Xt, Xt_store
 
+    def _sample_step(self, Xt, c_i, t_is, context_mask, z, i, guide_w):
+        """
+        One reverse diffusion step, Xt holds the sample twice (with / without
+        condition), guide_w is per sample and i is a 0-dim index tensor on device
+        """
+        n_sample = Xt.shape[0] // 2
+
+        # Step 4-1: predicted noise
+        eps = self.nn_model(Xt, c_i, t_is, context_mask)
+
+        # Step 4-2: X(t-1)
+        eps1 = eps[:n_sample]  # with condition
+        eps2 = eps[n_sample:]  # without condition
+        eps = (1 + guide_w) * eps1 - guide_w * eps2
+        Xt = Xt[:n_sample]
+        sched_i = self.sched[:, i]
+        Xt = (
+            sched_i[SCHEDULE_ROWS["oneover_sqrta"]] * Xt
+            - self.eps_coef[i] * eps
+            + sched_i[SCHEDULE_ROWS["sqrt_beta_t"]] * z
+        )
+        return Xt
+
+
+def is_local_main():
+    # LOCAL_RANK is only set by torchrun, a plain run is its own main process
+    return int(os.environ.get("LOCAL_RANK", 0)) == 0
+
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temp file and rename it into place, so readers never
+    see a truncated or half-written file
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
 
 class ImageDataset(Dataset):
-    def __init__(self, file_path, csv_path, transform=None):
+    def __init__(self, file_path, csv_path, transform=None, cache_path=None):
         self.csv_path = csv_path
         self.path = file_path
+        self.cache_path = cache_path
         self.transform = transform
         if transform:
             self.transform = transform
@@ -313,24 +464,86 @@ class ImageDataset(Dataset):
                 ]
             )
 
-        self.imgname_csv = []
-        self.labels_csv = []
-        self.files = []
-        self.labels = []
+        # (files, labels) from the csv + directory walk, cached next to the csv
+        # so later runs and every DDP rank skip the rescan. One process per
+        # node rebuilds it when the csv was edited or pngs were added to /
+        # removed from the data dir (csv and dir mtime), the others wait
+        index_path = os.path.splitext(self.csv_path)[0] + ".idx.pt"
+        index_key = {
+            "path": self.path,
+            "csv_mtime": os.path.getmtime(self.csv_path),
+            "dir_mtime": os.path.getmtime(self.path),
+        }
+        index = None
+        if is_local_main():
+            index = self.load_index(index_path, index_key)
+            if index is None:
+                index = dict(index_key, **self.build_index())
+                atomic_save(index, index_path)
+        barrier()
+        if index is None:
+            index = torch.load(index_path)
+        self.files, self.labels = index["files"], index["labels"]
+
+        # decode every png once into a single uint8 (N, C, H, W) tensor,
+        # __getitem__ then matches transforms.ToTensor() without touching PIL
+        # same build-once-per-node / wait / load scheme as the index, the cache
+        # stores the file list it was decoded from so it can't drift from it.
+        # Labels always come from the index, which tracks csv edits
+        self.images = None
+        if self.cache_path:
+            if is_local_main() and not self.cache_valid():
+                self.build_cache()
+            barrier()
+            cache = torch.load(self.cache_path, mmap=True)
+            self.images = cache["images"]
+            assert len(self.images) == len(self.files), "stale image cache"
+
+    @staticmethod
+    def load_index(index_path, index_key):
+        # the cached index, or None if it is missing or out of date
+        if not os.path.exists(index_path):
+            return None
+        index = torch.load(index_path)
+        if any(index.get(k) != v for k, v in index_key.items()):
+            return None
+        return index
+
+    def build_index(self):
+        files = []
+        labels = []
         with open(self.csv_path, "r", newline="") as file:
             reader = csv.reader(file, delimiter=",")
             next(reader)
-            for row in reader:
-                img_name, label = row
-                self.imgname_csv.append(img_name)
-                self.labels_csv.append(torch.tensor(int(label)))
+            # image name -> label, O(1) lookup below
+            label_map = {img_name: int(label) for img_name, label in reader}
 
         for x in os.listdir(self.path):
-            if x.endswith(".png") and x in self.imgname_csv:
-                self.files.append(os.path.join(self.path, x))
-                self.labels.append(self.labels_csv[self.imgname_csv.index(x)])
+            if x.endswith(".png") and x in label_map:
+                files.append(os.path.join(self.path, x))
+                labels.append(label_map[x])
+
+        # one int64 tensor instead of a 0-dim tensor (and zip record) per label
+        return {"files": files, "labels": torch.tensor(labels, dtype=torch.long)}
+
+    def cache_valid(self):
+        if not os.path.exists(self.cache_path):
+            return False
+        return torch.load(self.cache_path, mmap=True)["files"] == self.files
+
+    def build_cache(self):
+        images = None
+        for i, f in enumerate(tqdm(self.files, desc="decoding images")):
+            img = np.asarray(Image.open(f).convert("RGB"))
+            if images is None:
+                h, w, ch = img.shape
+                images = torch.empty((len(self.files), ch, h, w), dtype=torch.uint8)
+            images[i] = torch.from_numpy(img).permute(2, 0, 1)
+        atomic_save({"files": self.files, "images": images}, self.cache_path)
 
     def __getitem__(self, idx):
+        if self.images is not None:
+            return self.images[idx].float() / 255.0, self.labels[idx]
         data = Image.open(self.files[idx])
         data = self.transform(data)
         return data, self.labels[idx]
@@ -339,16 +552,49 @@ class ImageDataset(Dataset):
         return len(self.files)
 
 
+def gpu_batches(images, labels, batch_size, seed, rank=0, world_size=1):
+    """
+    shuffled batches indexed straight from device memory, the last partial
+    batch is dropped and every rank gets the same number of batches
+    """
+    g = torch.Generator(device=images.device)
+    g.manual_seed(seed)
+    perm = torch.randperm(len(images), generator=g, device=images.device)
+    perm = perm[: len(perm) // world_size * world_size][rank::world_size]
+    for i in range(0, len(perm) - batch_size + 1, batch_size):
+        idx = perm[i : i + batch_size]
+        yield images[idx].float() / 255.0, labels[idx]
+
+
 def train():
+    # must be set before the first cuda allocation, an exported value wins
+    os.environ.setdefault(
+        "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128"
+    )
+
     # hardcoding these here
     n_epoch = 100
     batch_size = 512
     n_T = 500  # 500
-    device = "cuda:2" if torch.cuda.is_available() else "cpu"
+    # launched with torchrun -> one process per GPU, otherwise single device
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        dist.init_process_group(backend="nccl")
+        local_rank = int(os.environ["LOCAL_RANK"])
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        local_rank = 0
+        rank, world_size = 0, 1
+        device = "cuda:2" if torch.cuda.is_available() else "cpu"
     n_classes = 10
     n_feat = 256  # 128 ok, 256 better (but slower)
     lrate = 2e-4
+    upsample = "transpose"  # "nearest": Upsample + Conv2d in UnetUp, needs --upsample nearest at inference
     save_model = True
+    use_amp = torch.cuda.is_available()
+    torch.backends.cudnn.benchmark = True  # fixed 28x28 input, let cuDNN pick the fastest kernels
     save_dir = "p1_svhn_b512_f256_lr2e-4_d0.2/"
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir, exist_ok=True)
@@ -357,82 +603,120 @@ def train():
     ws_test = [0.0, 0.5, 2.0]  # strength of generative guidance
 
     ddpm = DDPM(
-        nn_model=ContextUnet(in_channels=3, n_feat=n_feat, n_classes=n_classes),
+        nn_model=ContextUnet(
+            in_channels=3, n_feat=n_feat, n_classes=n_classes, upsample=upsample
+        ),
         betas=(1e-4, 0.02),
         n_T=n_T,
         device=device,
         drop_prob=0.2,
+        compile_model=torch.cuda.is_available(),  # CUDA graphs only pay off on gpu
     )
     ddpm.to(device)
-
-    tf = transforms.Compose(
-        [transforms.ToTensor()]
-    )  # mnist is already normalised 0 to 1
+    # NHWC layout for the Tensor Core conv kernels used under AMP
+    ddpm.nn_model.to(memory_format=torch.channels_last)
+    model = DistributedDataParallel(ddpm, device_ids=[local_rank]) if distributed else ddpm
 
     # train_dir = "hw2_data/digits/mnistm/data"
     # train_dir_csv = "hw2_data/digits/mnistm/train.csv"
     train_dir = "hw2_data/digits/svhn/data"
     train_dir_csv = "hw2_data/digits/svhn/train.csv"
 
+    # pre-decoded images, scaled to [0, 1] like transforms.ToTensor()
     dataset = ImageDataset(
         file_path=train_dir,
         csv_path=train_dir_csv,
-        transform=tf,
+        cache_path=os.path.splitext(train_dir_csv)[0] + "_cache.pt",
     )
 
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=5)
-    optim = torch.optim.Adam(ddpm.parameters(), lr=lrate)
+    # the whole uint8 dataset fits in GPU memory, batches are sliced on device
+    # (static batch size, see gpu_batches) instead of going through a DataLoader
+    images = dataset.images.to(device)
+    labels = dataset.labels.to(device)
+    n_batch = len(images) // world_size // batch_size
+
+    # per-run shuffle seed, rank 0's draw is shared so all ranks use the same
+    # permutation (gpu_batches shards it) while different runs still differ
+    base_seed = torch.randint(0, 2**31 - 1, (1,), device=device)
+    if distributed:
+        dist.broadcast(base_seed, src=0)
+    base_seed = int(base_seed.item())
+    # fused AdamW runs the whole parameter update in one kernel on cuda,
+    # no weight decay so the update matches the previous Adam
+    optim = torch.optim.AdamW(
+        ddpm.parameters(), lr=lrate, weight_decay=0.0, fused=torch.cuda.is_available()
+    )
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     for ep in range(n_epoch):
-        print(f"epoch {ep}")
+        if rank == 0:
+            print(f"epoch {ep}")
         ddpm.train()
 
         # linear lrate decay
         optim.param_groups[0]["lr"] = lrate * (1 - ep / n_epoch)
 
-        pbar = tqdm(dataloader)
+        batches = gpu_batches(
+            images, labels, batch_size, base_seed + ep, rank, world_size
+        )
+        pbar = tqdm(batches, total=n_batch, disable=rank != 0)
         loss_ema = None
         for x, c in pbar:
-            optim.zero_grad()
-            x = x.to(device)
+            optim.zero_grad(set_to_none=True)
+            x = x.to(device, memory_format=torch.channels_last, non_blocking=True)
             c = c.to(device)
-            loss = ddpm(x, c)
-            loss.backward()
+            # mixed precision forward, schedule buffers stay in fp32
+            with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=use_amp):
+                loss = model(x, c)
+            scaler.scale(loss).backward()
             if loss_ema is None:
                 loss_ema = loss.item()
             else:
                 loss_ema = 0.95 * loss_ema + 0.05 * loss.item()
             pbar.set_description(f"loss: {loss_ema:.4f}")
-            optim.step()
-
-        # for eval, save an image of currently generated samples (top rows)
-        # followed by real images (bottom rows)
-        ddpm.eval()
-        with torch.no_grad():
-            n_sample = 4 * n_classes
-            for w_i, w in enumerate(ws_test):
-                x_gen, x_gen_store = ddpm.sample(
-                    n_sample, (3, 28, 28), device, guide_w=w
+            scaler.step(optim)
+            scaler.update()
+
+        # eval and checkpoints on the global main process only, the other
+        # ranks wait so they don't sit in the next allreduce meanwhile
+        if rank == 0:
+            # for eval, save an image of currently generated samples (top rows)
+            # followed by real images (bottom rows)
+            ddpm.eval()
+            with torch.inference_mode():
+                n_sample = 4 * n_classes
+                # all guidance strengths share one 500-step sampling loop
+                x_gen_all, x_gen_store = ddpm.sample(
+                    n_sample, (3, 28, 28), device, guide_w=ws_test
                 )
-                # append some real images at bottom, order by class also
-                x_real = torch.Tensor(x_gen.shape).to(device)
-                for k in range(n_classes):
-                    for j in range(int(n_sample / n_classes)):
-                        try:
-                            idx = torch.squeeze((c == k).nonzero())[j]
-                        except:
-                            idx = 0
-                        x_real[k + (j * n_classes)] = x[idx]
-
-                x_all = torch.cat([x_gen, x_real])
-                grid = make_grid(x_all * -1 + 1, nrow=10)
-                save_image(grid, save_dir + f"image_ep{ep}_w{w}.png")
-                print("saved image at " + save_dir + f"image_ep{ep}_w{w}.png")
-
-        # optionally save model
-        if save_model and ep == int(n_epoch - 1) or ep % 10 == 0:
-            torch.save(ddpm.state_dict(), save_dir + f"model_{ep}.pth")
-            print("saved model at " + save_dir + f"model_{ep}.pth")
+                for w_i, w in enumerate(ws_test):
+                    x_gen = x_gen_all[w_i]
+                    # append some real images at bottom, order by class also
+                    x_real = torch.Tensor(x_gen.shape).to(device)
+                    for k in range(n_classes):
+                        for j in range(int(n_sample / n_classes)):
+                            try:
+                                idx = torch.squeeze((c == k).nonzero())[j]
+                            except:
+                                idx = 0
+                            x_real[k + (j * n_classes)] = x[idx]
+
+                    x_all = torch.cat([x_gen, x_real])
+                    grid = make_grid(x_all * -1 + 1, nrow=10)
+                    save_image(grid, save_dir + f"image_ep{ep}_w{w}.png")
+                    print("saved image at " + save_dir + f"image_ep{ep}_w{w}.png")
+
+            # hand the sampling temporaries back so training resumes on a compact pool
+            torch.cuda.empty_cache()
+
+            # optionally save model
+            if save_model and ep == int(n_epoch - 1) or ep % 10 == 0:
+                torch.save(ddpm.state_dict(), save_dir + f"model_{ep}.pth")
+                print("saved model at " + save_dir + f"model_{ep}.pth")
+        barrier()
+
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":